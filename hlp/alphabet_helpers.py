@@ -19,9 +19,9 @@ def get_alphabet_units_from_input_data(csv_filename: str,
     :param split_char: splitting character in input_data separting the alphabet units
     :return:
     """
-    df = pd.read_csv(csv_filename, sep=';', header=None, names=['image', 'labels'],
-                     encoding='utf8', escapechar="\\", quoting=3)
-    transcriptions = list(df.labels.apply(lambda x: x.split(split_char)))
+    df = pd.read_csv(csv_filename, sep=';', header=None, names=['image', 'labels'], usecols=['labels'],
+                     dtype={'labels': str}, encoding='utf8', escapechar="\\", quoting=3)
+    transcriptions = df.labels.str.split(split_char).to_list()
 
     unique_units = np.unique([chars for list_chars in transcriptions for chars in list_chars])
 
@@ -5,15 +5,17 @@ __license__ = "MIT"
 
 import os, sys
 import re
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 
 import cv2
 import click
+import numpy as np
 import pandas as pd
 from sklearn.model_selection import train_test_split
 
 from alphabet_helpers import generate_alphabet_file
-from string_data_manager import tf_crnn_label_formatting
+from string_data_manager import tf_crnn_label_formatting, CSV_WRITE_BUFFER_SIZE, CSV_WRITE_CHUNK_SIZE
 
 
 def mkdir(dir_path):
@@ -23,62 +25,52 @@ def mkdir(dir_path):
 @click.command()
 @click.option('--download_dir')
 @click.option('--generated_data_dir')
+@click.option('--random_state', type=int, default=121, help='Seed used to split the data')
 def prepare_data(download_dir: str,
-                 generated_data_dir: str):
+                 generated_data_dir: str,
+                 random_state: int):
 
     print('Generating files for the experiment...')
 
     mkdir(generated_data_dir)
 
-    raw_df = pd.read_csv(os.path.join(download_dir, 'trainVal.csv'))
-    gen_df = pd.DataFrame(columns=['img_url', 'label'])
+    raw_df = pd.read_csv(os.path.join(download_dir, 'trainVal.csv'),
+                         usecols=['image_path', 'lp'],
+                         dtype={'image_path': str, 'lp': str})
 
-    for i, row in raw_df.iterrows():
-        if i % 1000 == 0:
-            print("Processed {} rows".format(i))
+    # Build paths and formatted labels column-wise instead of row by row
+    src_files = (os.path.join(download_dir, '') + raw_df['image_path']).str.replace('\\', '/', regex=False)
+    labels = '|' + raw_df['lp'].str.strip().map('|'.join) + '|'
 
-        src_file = os.path.join(download_dir, row['image_path'])
-        # dst_file = os.path.join(generated_data_dir, row['lp'] + '.jpg')
+    gen_df = pd.DataFrame({'img_url': src_files, 'label': labels})
 
-        # img = cv2.imread(src_file, cv2.IMREAD_GRAYSCALE)
-        # cv2.imwrite(dst_file, img)
-
-        src_file = src_file.replace('\\', '/')
-        label = '|' + '|'.join(list(row['lp'].strip())) + '|'
+    print('Saving CSVs...')
 
-        # gen_df.loc[i] = [dst_file, label]
-        gen_df.loc[i] = [src_file, label]
+    # Split the row indices rather than the DataFrame to avoid copying it
+    train_idx, test_idx = train_test_split(np.arange(len(gen_df)), test_size=0.2, random_state=random_state)
 
-    print('Saving CSVs...')
+    test_idx, val_idx = train_test_split(test_idx, test_size=0.5, random_state=random_state)
 
-    train_df, test_df = train_test_split(gen_df, test_size=0.2)
-
-    test_df, val_df = train_test_split(test_df, test_size=0.5)
-
-    train_df.to_csv(os.path.join(generated_data_dir, 'train.csv'),
-                    sep=';',
-                    encoding='utf-8',
-                    header=False,
-                    index=False)
-    test_df.to_csv(os.path.join(generated_data_dir, 'test.csv'),
-                   sep=';',
-                   encoding='utf-8',
-                   header=False,
-                   index=False)
-    val_df.to_csv(os.path.join(generated_data_dir, 'val.csv'),
-                  sep=';',
-                  encoding='utf-8',
-                  header=False,
-                  index=False)
+    # Large write buffer and chunked formatting to limit syscalls and memory use
+    for csv_filename, split_idx in [('train.csv', train_idx), ('test.csv', test_idx), ('val.csv', val_idx)]:
+        with open(os.path.join(generated_data_dir, csv_filename), 'w', encoding='utf-8', newline='',
+                  buffering=CSV_WRITE_BUFFER_SIZE) as f:
+            gen_df.iloc[split_idx].to_csv(f,
+                                          sep=';',
+                                          header=False,
+                                          index=False,
+                                          chunksize=CSV_WRITE_CHUNK_SIZE)
 
     print('Format string label to tf_crnn formatting...')
 
-    for csv_filename in glob(os.path.join(generated_data_dir, '*.csv')):
-        tf_crnn_label_formatting(csv_filename)
+    csv_filenames = glob(os.path.join(generated_data_dir, '*.csv'))
+    # Files are independent, format them in parallel
+    with ProcessPoolExecutor(max_workers=len(csv_filenames)) as executor:
+        list(executor.map(tf_crnn_label_formatting, csv_filenames))
 
     print('Generating alphabet...')
 
-    generate_alphabet_file(glob(os.path.join(generated_data_dir, '*.csv')),
+    generate_alphabet_file(csv_filenames,
                            os.path.join(generated_data_dir, 'alphabet_lookup.json'))
 
     return 0
@@ -4,6 +4,9 @@ __licence__ = 'GPL'
 
 import pandas as pd
 
+CSV_WRITE_BUFFER_SIZE = 1 << 20  # 1 MiB buffer for the exported csv files
+CSV_WRITE_CHUNK_SIZE = 50000  # number of rows formatted at once by DataFrame.to_csv
+
 _accents_list = 'àéèìîóòù'
 _accent_mapping = {'à': 'a',
                    'é': 'e',
@@ -115,7 +118,8 @@ def tf_crnn_label_formatting(csv_filename: str):
 
     df.labels = df.labels.apply(lambda x: _string_formatting(x))
 
-    df.to_csv(csv_filename, sep=';', encoding='utf-8', header=False, index=False, escapechar="\\", quoting=3)
+    with open(csv_filename, 'w', encoding='utf-8', newline='', buffering=CSV_WRITE_BUFFER_SIZE) as f:
+        df.to_csv(f, sep=';', header=False, index=False, escapechar="\\", quoting=3, chunksize=CSV_WRITE_CHUNK_SIZE)
 
 
 def lower_abbreviation_in_string(string_to_format: str):
@@ -18,9 +18,12 @@ Model definitions
 
 .. autosummary::
     ConvBlock
+    CERMetric
+    CTCLossLayer
     get_model_train
     get_model_inference
     get_crnn_output
+    build_backbone
 
 
 Config for training
@@ -73,9 +76,12 @@ _CONFIG = [
 
 _MODEL = [
     'ConvBlock',
+    'CERMetric',
+    'CTCLossLayer',
     'get_model_train',
-    'get_model_inference'
-    'get_crnn_output'
+    'get_model_inference',
+    'get_crnn_output',
+    'build_backbone'
 ]
 
 _CALLBACKS = [
@@ -15,6 +15,7 @@ import pandas as pd
 class CONST:
     DIMENSION_REDUCTION_W_POOLING = 2*2  # 2x2 pooling in dimension W on layer 1 and 2
     PREPROCESSING_FOLDER = 'preprocessed'
+    CSV_IO_BUFFER_SIZE = 1 << 20  # 1 MiB buffer to read and write the preprocessed csv files
 
 
 class Alphabet:
@@ -134,8 +135,8 @@ class Alphabet:
         for filename in csv_files:
             data = pd.read_csv(filename, sep=';', encoding='utf8', error_bad_lines=False, header=None,
                                names=['path', 'transcription'], escapechar='\\')
-            for index, row in data.iterrows():
-                set_chars.update(row.transcription.split('|'))
+            for transcription in data.transcription:
+                set_chars.update(transcription.split('|'))
 
         # Update (key, values) of lookup table
         for el in set_chars:
@@ -224,6 +225,8 @@ class Params:
     :ivar cnn_batch_norm: a list of length `n_layers` containing a bool that indicated wether or not to use batch normalization
         (default: [False, False, False, False, False])
     :vartype cnn_batch_norm: List(bool)
+    :ivar cnn_batch_renorm: whether to use batch renormalization in the batch normalization layers (default: False)
+    :vartype cnn_batch_renorm: bool
     :ivar rnn_units: a list containing the number of units per rnn layer (default: 256)
     :vartype rnn_units: List(int)
     :ivar num_beam_paths: number of paths (transcriptions) to return for ctc beam search (only used when predicting)
@@ -266,6 +269,9 @@ class Params:
     :vartype output_model_dir: str
     :ivar restore_model: boolean to continue training with saved weights (default: False)
     :vartype restore_model: bool
+    :ivar mixed_precision: mixed precision policy of the network ('mixed_float16' or 'mixed_bfloat16'),
+        None to use float32 (default: None). Requires TensorFlow >= 2.4
+    :vartype mixed_precision: str
     """
     def __init__(self, **kwargs):
         # model params
@@ -276,6 +282,7 @@ class Params:
         self.cnn_stride_size = kwargs.get('cnn_stride_size', [(1, 1), (1, 1), (1, 1), (1, 1), (1, 1)])
         self.cnn_pool_size = kwargs.get('cnn_pool_size', [(2, 2), (2, 2), (2, 2), (2, 2), (1, 1)])
         self.cnn_batch_norm = kwargs.get('cnn_batch_norm', [False, False, False, False, False])
+        self.cnn_batch_renorm = kwargs.get('cnn_batch_renorm', False)
         self.rnn_units = kwargs.get('rnn_units', [256, 256])
         # self._keep_prob_dropout = kwargs.get('keep_prob_dropout', 0.5)
         self.num_beam_paths = kwargs.get('num_beam_paths', 1)
@@ -302,6 +309,7 @@ class Params:
         self.evaluate_every_epoch = kwargs.get('evaluate_every_epoch', 5)
         self.save_interval = kwargs.get('save_interval', 20)
         self.restore_model = kwargs.get('restore_model', False)
+        self.mixed_precision = kwargs.get('mixed_precision', None)
 
         self._assign_alphabet()
 
@@ -320,6 +328,12 @@ class Params:
                                                                                       self.input_shape[1])
 
         assert self.optimizer in ['adam', 'rms', 'ada'], 'Unknown optimizer {}'.format(self.optimizer)
+        assert self.mixed_precision in [None, 'mixed_float16', 'mixed_bfloat16'], \
+            'Unknown mixed precision policy {}'.format(self.mixed_precision)
+        if self.mixed_precision:
+            import tensorflow as tf
+            assert hasattr(tf.keras.mixed_precision, 'set_global_policy'), \
+                'Mixed precision requires TensorFlow >= 2.4 (found {})'.format(tf.__version__)
 
         if os.path.isdir(self.output_model_dir):
             print('WARNING : The output directory {} already exists.'.format(self.output_model_dir))
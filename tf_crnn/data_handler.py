@@ -263,7 +263,7 @@ def dataset_generator(csv_filename: Union[List[str], str],
     :param use_labels: boolean to indicate dataset generation during training / evaluation (true) or prediction (false)
     :param batch_size: size of the generated batches
     :param data_augmentation: whether to use data augmentation strategies or not
-    :param num_epochs: number of epochs to repeat the dataset generation
+    :param num_epochs: number of epochs to repeat the dataset generation (-1 to repeat indefinitely)
     :param shuffle: whether to suffle the data
     :return: ``tf.data.Dataset``
     """
@@ -387,12 +387,9 @@ def dataset_generator(csv_filename: Union[List[str], str],
 
         input_seq_length = tf.cast(tf.floor(tf.divide(img_width, params.downscale_factor)), tf.int32)
         if use_labels:
-            assert_op = tf.debugging.assert_greater_equal(input_seq_length,
-                                                          features['label_seq_length'])
-            with tf.control_dependencies([assert_op]):
-                return {'input_images': image,
-                        'label_seq_length': features['label_seq_length'],
-                        'input_seq_length': input_seq_length}, labels
+            return {'input_images': image,
+                    'label_seq_length': features['label_seq_length'],
+                    'input_seq_length': input_seq_length}, labels
         else:
             return {'input_images': image,
                     'input_seq_length': input_seq_length,
@@ -405,6 +402,9 @@ def dataset_generator(csv_filename: Union[List[str], str],
         features['input_images'] = image
         return features, labels if use_labels else features
 
+    def _has_valid_seq_length(features: dict, labels=None):
+        return tf.greater(features['input_seq_length'], features['label_seq_length'])
+
     def _format_label_codes(features: dict, string_label_codes):
         splits = tf.strings.split([string_label_codes], sep=' ')
         label_codes = tf.squeeze(tf.strings.to_number(splits, out_type=tf.int32), axis=0)
@@ -424,6 +424,8 @@ def dataset_generator(csv_filename: Union[List[str], str],
         dataset = dataset.map(_data_augment_fn, num_parallel_calls=num_parallel_calls)
     dataset = dataset.map(_normalize_image, num_parallel_calls=num_parallel_calls)
     dataset = dataset.map(_pad_image_or_resize, num_parallel_calls=num_parallel_calls)
+    # Remove items with longer label than input
+    dataset = dataset.filter(_has_valid_seq_length) if use_labels else dataset
     dataset = dataset.map(_format_label_codes, num_parallel_calls=num_parallel_calls) if use_labels else dataset
     dataset = dataset.shuffle(10 * batch_size, reshuffle_each_iteration=False) if shuffle else dataset
     dataset = dataset.repeat(num_epochs) if num_epochs is not None else dataset
@@ -5,8 +5,8 @@ __license__ = "GPL"
 import tensorflow as tf
 from tensorflow.keras import Model
 from tensorflow.keras.backend import ctc_batch_cost, ctc_decode
-from tensorflow.keras.layers import Layer, Conv2D, BatchNormalization, MaxPool2D, Input, Permute, \
-    Reshape, Bidirectional, LSTM, Dense, Softmax, Lambda
+from tensorflow.keras.layers import Layer, Conv2D, BatchNormalization, MaxPool2D, Input, Bidirectional, LSTM, \
+    Dense, Softmax, Lambda, Dropout
 from typing import List, Tuple
 from .config import Params
 
@@ -29,6 +29,8 @@ class ConvBlock(Layer):
     :vartype pool_size: int, int
     :ivar batchnorm: use batch norm or not
     :vartype batchnorm: bool
+    :ivar batch_renorm: use batch renormalization in the batch norm layer or not
+    :vartype batch_renorm: bool
     """
     def __init__(self,
                  features: int,
@@ -37,14 +39,15 @@ class ConvBlock(Layer):
                  cnn_padding: str,
                  pool_size: Tuple[int, int],
                  batchnorm: bool,
+                 batch_renorm: bool=False,
                  **kwargs):
         super(ConvBlock, self).__init__(**kwargs)
         self.conv = Conv2D(features,
                            kernel_size,
                            strides=stride,
                            padding=cnn_padding)
-        self.bn = BatchNormalization(renorm=True,
-                                     renorm_clipping={'rmax': 1e2, 'rmin': 1e-1, 'dmax': 1e1},
+        self.bn = BatchNormalization(renorm=batch_renorm,
+                                     renorm_clipping={'rmax': 1e2, 'rmin': 1e-1, 'dmax': 1e1} if batch_renorm else None,
                                      trainable=True) if batchnorm else None
         self.pool = MaxPool2D(pool_size=pool_size,
                               padding='same') if list(pool_size) > [1, 1] else None
@@ -56,6 +59,7 @@ class ConvBlock(Layer):
         self._cnn_padding = cnn_padding
         self._pool_size = pool_size
         self._batchnorm = batchnorm
+        self._batch_renorm = batch_renorm
 
     def call(self, inputs, training=False):
         x = self.conv(inputs)
@@ -79,11 +83,92 @@ class ConvBlock(Layer):
             'stride': self._stride,
             'cnn_padding': self._cnn_padding,
             'pool_size': self._pool_size,
-            'batchnorm': self._batchnorm
+            'batchnorm': self._batchnorm,
+            'batch_renorm': self._batch_renorm
         }
         return dict(list(super_config.items()) + list(config.items()))
 
 
+class CERMetric(tf.keras.metrics.Metric):
+    """
+    Character Error Rate metric.
+    Accumulates the edit distance between the greedy decoded predictions and the labels, and the number of
+    characters of the labels, over the batches. The result is the total distance over the total number of characters.
+
+    :ivar accumulated_distance: sum of the edit distances
+    :vartype accumulated_distance: tf.Variable
+    :ivar accumulated_chars: sum of the lengths of the labels
+    :vartype accumulated_chars: tf.Variable
+    """
+    def __init__(self,
+                 name: str='CER',
+                 **kwargs):
+        super(CERMetric, self).__init__(name=name, **kwargs)
+        self.accumulated_distance = self.add_weight(name='accumulated_distance', initializer='zeros')
+        self.accumulated_chars = self.add_weight(name='accumulated_chars', initializer='zeros')
+
+    def update_state(self,
+                     label_codes: tf.Tensor,
+                     y_pred: tf.Tensor,
+                     input_seq_len: tf.Tensor,
+                     label_seq_length: tf.Tensor,
+                     sample_weight=None):
+        """
+        Updates the accumulated distance and characters count with a batch.
+
+        :param label_codes: dense label codes, padded with 0 (B, max_chars_per_string)
+        :param y_pred: output of the network (B, W, n_classes)
+        :param input_seq_len: length of the input sequences (B, 1)
+        :param label_seq_length: length of the label sequences (B, 1)
+        :param sample_weight: unused
+        :return:
+        """
+        # y_pred needs to be decoded (its the logits)
+        pred_codes_dense = ctc_decode(y_pred, tf.squeeze(input_seq_len, axis=-1), greedy=True)
+        pred_codes_dense = tf.squeeze(tf.cast(pred_codes_dense[0], tf.int64), axis=0)  # only [0] if greedy=true
+
+        # create sparse tensors (decoded codes are padded with -1 and labels with 0)
+        pred_codes_sparse = tf.sparse.from_dense(tf.where(tf.equal(pred_codes_dense, -1),
+                                                          tf.zeros_like(pred_codes_dense),
+                                                          pred_codes_dense))
+        label_sparse = tf.sparse.from_dense(tf.cast(label_codes, tf.int64))
+
+        # Compute edit distance and total chars count
+        distance = tf.reduce_sum(tf.edit_distance(pred_codes_sparse, label_sparse, normalize=False))
+        count_chars = tf.reduce_sum(label_seq_length)
+
+        self.accumulated_distance.assign_add(distance)
+        self.accumulated_chars.assign_add(tf.cast(count_chars, tf.float32))
+
+    def result(self):
+        return tf.math.divide_no_nan(self.accumulated_distance, self.accumulated_chars)
+
+
+class CTCLossLayer(Layer):
+    """
+    Layer adding the CTC loss and the CER metric (``CERMetric``) to the model.
+    The labels and sequence lengths are inputs of the layer, thus the loss and the metric do not depend on
+    tensors captured outside of the model graph. The output of the network is returned unchanged.
+    The CTC ops only support float32 and float64, so the layer should be created with ``dtype='float32'``
+    when using mixed precision.
+
+    :ivar cer_metric: Character Error Rate metric
+    :vartype cer_metric: CERMetric
+    """
+    def __init__(self, **kwargs):
+        super(CTCLossLayer, self).__init__(**kwargs)
+        self.cer_metric = CERMetric(name='CER')
+
+    def call(self, inputs, **kwargs):
+        label_codes, y_pred, input_seq_len, label_seq_length = inputs
+        y_pred = tf.cast(y_pred, tf.float32)
+
+        self.add_loss(tf.reduce_mean(_ctc_loss(label_codes, y_pred, input_seq_len, label_seq_length)))
+        self.add_metric(self.cer_metric(label_codes, y_pred, input_seq_len, label_seq_length))
+
+        return y_pred
+
+
 def get_crnn_output(input_images,
                     parameters: Params=None) -> tf.Tensor:
     """
@@ -101,40 +186,87 @@ def get_crnn_output(input_images,
     cnn_pool_size = parameters.cnn_pool_size
     cnn_stride_size = parameters.cnn_stride_size
     cnn_batch_norm = parameters.cnn_batch_norm
+    cnn_batch_renorm = parameters.cnn_batch_renorm
     rnn_units = parameters.rnn_units
 
     # CNN layers
     cnn_params = zip(cnn_features_list, cnn_kernel_size, cnn_stride_size, cnn_pool_size, cnn_batch_norm)
-    conv_layers = [ConvBlock(ft, ks, ss, 'same', psz, bn) for ft, ks, ss, psz, bn in cnn_params]
+    conv_layers = [ConvBlock(ft, ks, ss, 'same', psz, bn, cnn_batch_renorm) for ft, ks, ss, psz, bn in cnn_params]
 
-    x = conv_layers[0](input_images)
-    for conv in conv_layers[1:]:
-        x = conv(x)
+    cnn_backbone = tf.keras.Sequential(conv_layers, name='cnn_backbone')
+    x = cnn_backbone(input_images)
 
-    # Permutation and reshape
-    x = Permute((2, 1, 3))(x)
-    shape = x.get_shape().as_list()
-    x = Reshape((shape[1], shape[2] * shape[3]))(x)  # [B, W, H*C]
+    # Permutation and reshape in a single layer [B, H, W, C] -> [B, W, H*C]
+    x = Lambda(lambda t: tf.reshape(tf.transpose(t, [0, 2, 1, 3]), [-1, t.shape[2], t.shape[1] * t.shape[3]]),
+               name='cnn_to_rnn')(x)
 
     # RNN layers
-    rnn_layers = [Bidirectional(LSTM(ru, dropout=0.5, return_sequences=True, time_major=False)) for ru in
-                  rnn_units]
+    # Dropout is applied on the inputs by a separate layer so that LSTM can use the fused cuDNN kernel
+    rnn_layers = [Bidirectional(LSTM(ru, return_sequences=True, time_major=False)) for ru in rnn_units]
     for rnn in rnn_layers:
+        x = Dropout(0.5)(x)
         x = rnn(x)
 
     # Dense and softmax
     x = Dense(parameters.alphabet.n_classes)(x)
-    net_output = Softmax()(x)
+    net_output = Softmax(dtype='float32')(x)  # keep the output in float32 with mixed precision
 
     return net_output
 
 
-def get_model_train(parameters: Params):
+def build_backbone(parameters: Params) -> Model:
+    """
+    Creates the CRNN network as a standalone model.
+    The same backbone can be given to ``get_model_train`` and ``get_model_inference`` so that both models
+    share the same layers and weights.
+    The layers are created with the mixed precision policy of `parameters`, the global policy is left unchanged.
+
+    :param parameters: parameters of the model (``Params``)
+    :return: the CRNN model (``tf.Keras.Model``)
+    """
+    h, w = parameters.input_shape
+    c = parameters.input_channels
+
+    if parameters.mixed_precision:
+        previous_policy = tf.keras.mixed_precision.global_policy()
+        tf.keras.mixed_precision.set_global_policy(parameters.mixed_precision)
+
+    try:
+        input_images = Input(shape=(h, w, c))
+        backbone = Model(inputs=input_images, outputs=get_crnn_output(input_images, parameters), name='crnn_backbone')
+    finally:
+        if parameters.mixed_precision:
+            tf.keras.mixed_precision.set_global_policy(previous_policy)
+
+    return backbone
+
+
+@tf.function
+def _ctc_loss(label_codes: tf.Tensor,
+              y_pred: tf.Tensor,
+              input_seq_len: tf.Tensor,
+              label_seq_length: tf.Tensor) -> tf.Tensor:
+    """
+    CTC loss of a batch, run as a graph function.
+
+    :param label_codes: dense label codes, padded with 0 (B, max_chars_per_string)
+    :param y_pred: output of the network (B, W, n_classes)
+    :param input_seq_len: length of the input sequences (B, 1)
+    :param label_seq_length: length of the label sequences (B, 1)
+    :return: CTC loss of each sample (B, 1)
+    """
+    return ctc_batch_cost(label_codes, y_pred, input_seq_len, label_seq_length)
+
+
+def get_model_train(parameters: Params,
+                    backbone: Model=None):
     """
     Constructs the full model for training.
     Defines inputs and outputs, loss function and metric (CER).
 
     :param parameters: parameters of the model (``Params``)
+    :param backbone: CRNN network to use (see ``build_backbone``), a new one is created if None.
+        The mixed precision policy is the one the backbone has been built with
     :return: the model (``tf.Keras.Model``)
     """
 
@@ -147,51 +279,27 @@ def get_model_train(parameters: Params):
     label_codes = Input(shape=(parameters.max_chars_per_string), dtype=tf.int32, name='label_codes')
     label_seq_length = Input(shape=[1], dtype=tf.int32, name='label_seq_length')
 
-    net_output = get_crnn_output(input_images, parameters)
-
-    # Loss function
-    def warp_ctc_loss(y_true, y_pred):
-        return ctc_batch_cost(label_codes, y_pred, input_seq_len, label_seq_length)
-
-    # Metric function
-    def warp_cer_metric(y_true, y_pred):
-        pred_sequence_length, true_sequence_length = input_seq_len, label_seq_length
-
-        # y_pred needs to be decoded (its the logits)
-        pred_codes_dense = ctc_decode(y_pred, tf.squeeze(pred_sequence_length, axis=-1), greedy=True)
-        pred_codes_dense = tf.squeeze(tf.cast(pred_codes_dense[0], tf.int64), axis=0)  # only [0] if greedy=true
-
-        # create sparse tensor
-        idx = tf.where(tf.not_equal(pred_codes_dense, -1))
-        pred_codes_sparse = tf.SparseTensor(tf.cast(idx, tf.int64),
-                                            tf.gather_nd(pred_codes_dense, idx),
-                                            tf.cast(tf.shape(pred_codes_dense), tf.int64))
-
-        idx = tf.where(tf.not_equal(label_codes, 0))
-        label_sparse = tf.SparseTensor(tf.cast(idx, tf.int64),
-                                       tf.gather_nd(label_codes, idx),
-                                       tf.cast(tf.shape(label_codes), tf.int64))
-        label_sparse = tf.cast(label_sparse, tf.int64)
-
-        # Compute edit distance and total chars count
-        distance = tf.reduce_sum(tf.edit_distance(pred_codes_sparse, label_sparse, normalize=False))
-        count_chars = tf.reduce_sum(true_sequence_length)
+    if backbone is None:
+        backbone = build_backbone(parameters)
+    net_output = backbone(input_images)
 
-        return tf.divide(distance, tf.cast(count_chars, tf.float32), name='CER')
+    # Loss function and metric, added by a layer so that they are part of the model graph
+    net_output = CTCLossLayer(name='ctc_loss', dtype='float32')([label_codes, net_output, input_seq_len, label_seq_length])
 
     # Define model and compile it
     model = Model(inputs=[input_images, label_codes, input_seq_len, label_seq_length], outputs=net_output, name='CRNN')
     optimizer = tf.keras.optimizers.Adam(learning_rate=parameters.learning_rate)
-    model.compile(loss=[warp_ctc_loss],
-                  optimizer=optimizer,
-                  metrics=[warp_cer_metric],
-                  experimental_run_tf_function=False) # TODO this is set to true by default but does not seem to work...
+    if parameters.mixed_precision == 'mixed_float16':
+        # float16 gradients need loss scaling to avoid underflow
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    model.compile(optimizer=optimizer)
 
     return model
 
 
 def get_model_inference(parameters: Params,
-                        weights_path: str=None):
+                        weights_path: str=None,
+                        backbone: Model=None):
     """
     Constructs the full model for prediction.
     Defines inputs and outputs, and loads the weights.
@@ -199,6 +307,7 @@ def get_model_inference(parameters: Params,
 
     :param parameters: parameters of the model (``Params``)
     :param weights_path: path to the weights (.h5 file)
+    :param backbone: CRNN network to use (see ``build_backbone``), a new one is created if None
     :return: the model (``tf.Keras.Model``)
     """
     h, w = parameters.input_shape
@@ -208,7 +317,9 @@ def get_model_inference(parameters: Params,
     input_seq_len = Input(shape=[1], dtype=tf.int32, name='input_seq_length')
     filename_images = Input(shape=[1], dtype=tf.string, name='filename_images')
 
-    net_output = get_crnn_output(input_images, parameters)
+    if backbone is None:
+        backbone = build_backbone(parameters)
+    net_output = backbone(input_images)
     output_seq_len = tf.identity(input_seq_len)  # need this op to pass it to output
     filenames = tf.identity(filename_images)
 
@@ -2,13 +2,14 @@
 __author__ = "solivr"
 __license__ = "GPL"
 
-import re
+import csv
 import numpy as np
 import os
+from functools import reduce
+from concurrent.futures import ProcessPoolExecutor
 from .config import Params, CONST
 import pandas as pd
-from typing import List, Tuple
-from taputapu.io.image import get_image_shape_without_loading
+from typing import List
 
 
 def _convert_label_to_dense_codes(labels: List[str],
@@ -22,46 +23,56 @@ def _convert_label_to_dense_codes(labels: List[str],
     :param split_char: character to split the formatted label
     :param max_width: maximum length of string label (max_n_chars = max_width_dense_codes)
     :param table_str2int: mapping table between alphabet units and alphabet codes
-    :return: dense matrix N x max_width, list of the lengths of each string (length N)
+    :return: dense matrix N x max_width, array of the lengths of each string (length N)
     """
-    labels_chars = [[c for c in label.split(split_char) if c] for label in labels]
-    codes_list = [[table_str2int[c] for c in list_char] for list_char in labels_chars]
-
-    seq_lengths = [len(cl) for cl in codes_list]
+    # Empty units are never part of a label, since they are removed when splitting it
+    units = [unit for unit in table_str2int if unit]
+    if units and all(len(unit) == 1 for unit in units):
+        # Single character units : look up all the code points at once in a table indexed by ordinal
+        lookup_table = np.full(max(map(ord, units)) + 1, -1, dtype=np.int32)
+        for unit in units:
+            lookup_table[ord(unit)] = table_str2int[unit]
+
+        labels_chars = [label.replace(split_char, '') for label in labels]
+        seq_lengths = np.fromiter(map(len, labels_chars), dtype=np.int32, count=len(labels_chars))
+        code_points = np.frombuffer(''.join(labels_chars).encode('utf-32-le'), dtype=np.uint32)
+
+        is_known = code_points < len(lookup_table)
+        is_known[is_known] = lookup_table[code_points[is_known]] >= 0
+        if not np.all(is_known):
+            raise KeyError(chr(code_points[~is_known][0]))
+        codes = lookup_table[code_points]
+    else:
+        # Multiple characters units : the label needs to be split to retrieve the units
+        labels_chars = [[c for c in label.split(split_char) if c] for label in labels]
+        seq_lengths = np.fromiter(map(len, labels_chars), dtype=np.int32, count=len(labels_chars))
+        codes = np.fromiter((table_str2int[c] for list_char in labels_chars for c in list_char),
+                            dtype=np.int32, count=int(np.sum(seq_lengths)))
 
-    dense_codes = list()
-    for ls in codes_list:
-        dense_codes.append(ls + np.maximum(0, (max_width - len(ls))) * [0])
+    # Fill each row with its codes and pad with 0
+    width = max(max_width, int(np.max(seq_lengths, initial=0)))
+    dense_codes = np.zeros((len(labels), width), dtype=np.int32)
+    dense_codes[np.arange(width) < seq_lengths[:, None]] = codes
 
     return dense_codes, seq_lengths
 
 
-def _compute_length_inputs(path: str,
-                           target_shape: Tuple[int, int]):
-
-    w, h = get_image_shape_without_loading(path)
-    ratio = w / h
-
-    new_h = target_shape[0]
-    new_w = np.minimum(new_h * ratio, target_shape[1])
-
-    return new_w
-
-
 def preprocess_csv(csv_filename: str,
                    parameters: Params,
                    output_csv_filename: str) -> int:
     """
     Converts the original csv data to the format required by the experiment.
-    Removes the samples which labels have too many characters. Computes the widths of input images and removes the
-    samples which have more characters per label than image width. Converts the string labels to dense codes.
+    Removes the samples which labels have too many characters. Converts the string labels to dense codes.
+    The samples which have more characters per label than image width are filtered out by the input pipeline
+    (see ``dataset_generator``), where the image width is known without additional reading.
     The output csv file contains the path to the image, the dense list of codes corresponding to the alphabets units
     (which are padded with 0 if `len(label)` < `max_len`) and the length of the label sequence.
 
     :param csv_filename: path to csv file
     :param parameters: parameters of the experiment (``Params``)
     :param output_csv_filename: path to the output csv file
-    :return: number of samples in the output csv file
+    :return: number of rows in the output csv file, which is an upper bound of the number of samples
+             given by the input pipeline (the samples with too few input steps are filtered later)
     """
 
     # Conversion table
@@ -72,24 +83,19 @@ def preprocess_csv(csv_filename: str,
                             sep=parameters.csv_delimiter,
                             header=None,
                             names=['paths', 'labels'],
+                            dtype={'paths': str, 'labels': str},
                             encoding='utf8',
                             escapechar="\\",
                             quoting=0)
 
     original_len = len(dataframe)
 
-    dataframe['label_string'] = dataframe.labels.apply(lambda x: re.sub(re.escape(parameters.string_split_delimiter), '', x))
-    dataframe['label_len'] = dataframe.label_string.apply(lambda x: len(x))
+    dataframe['label_string'] = dataframe.labels.str.replace(parameters.string_split_delimiter, '', regex=False)
+    dataframe['label_len'] = dataframe.label_string.str.len().astype(np.int16)
 
     # remove long labels
     dataframe = dataframe[dataframe.label_len <= parameters.max_chars_per_string]
 
-    # Compute width images (after resizing)
-    dataframe['input_length'] = dataframe.paths.apply(lambda x: _compute_length_inputs(x, parameters.input_shape))
-    dataframe.input_length = dataframe.input_length.apply(lambda x: np.floor(x / parameters.downscale_factor))
-    # Remove items with longer label than input
-    dataframe = dataframe[dataframe.label_len < dataframe.input_length]
-
     final_length = len(dataframe)
 
     n_removed = original_len - final_length
@@ -97,9 +103,9 @@ def preprocess_csv(csv_filename: str,
         print('-- Removed {} samples ({:.2f} %)'.format(n_removed,
                                                         100 * n_removed / original_len))
 
-    # Convert fields to list
-    paths = dataframe.paths.to_list()
-    labels = dataframe.labels.to_list()
+    # Convert fields to arrays
+    paths = dataframe.paths.to_numpy()
+    labels = dataframe.labels.to_numpy()
 
     # Convert string labels to dense codes
     label_dense_codes, label_seq_length = _convert_label_to_dense_codes(labels,
@@ -107,29 +113,57 @@ def preprocess_csv(csv_filename: str,
                                                                         parameters.max_chars_per_string,
                                                                         table_str2int)
     # format in string to be easily parsed by tf.data
-    string_label_codes = [[str(ldc) for ldc in list_ldc] for list_ldc in label_dense_codes]
-    string_label_codes = [' '.join(list_slc) for list_slc in string_label_codes]
+    string_codes = np.char.mod('%d', label_dense_codes)
+    string_label_codes = reduce(lambda row, column: np.char.add(np.char.add(row, ' '), column), string_codes.T)
+
+    # Write the rows directly without building an intermediate DataFrame
+    with open(output_csv_filename, 'w', encoding='utf8', newline='', buffering=CONST.CSV_IO_BUFFER_SIZE) as f:
+        csv_writer = csv.writer(f,
+                                delimiter=parameters.csv_delimiter,
+                                escapechar="\\",
+                                quoting=csv.QUOTE_MINIMAL,
+                                lineterminator=os.linesep)
+        csv_writer.writerows(zip(paths, string_label_codes, label_seq_length))
 
-    data = {'paths': paths, 'label_codes': string_label_codes, 'label_len': label_seq_length}
-    new_dataframe = pd.DataFrame(data)
+    return len(paths)
 
-    new_dataframe.to_csv(output_csv_filename,
-                         sep=parameters.csv_delimiter,
-                         header=False,
-                         encoding='utf8',
-                         index=False,
-                         escapechar="\\",
-                         quoting=0)
-    return len(new_dataframe)
+
+def _is_up_to_date(output_filename: str,
+                   input_filenames: List[str]) -> bool:
+    """
+    Checks if a file exists and is more recent than all the files it has been generated from.
+
+    :param output_filename: path to the generated file
+    :param input_filenames: paths to the files used to generate `output_filename` (None entries are ignored)
+    :return: True if `output_filename` does not need to be generated again
+    """
+    if not os.path.isfile(output_filename):
+        return False
+
+    output_mtime = os.path.getmtime(output_filename)
+    return all(output_mtime >= os.path.getmtime(f) for f in input_filenames if f)
+
+
+def _count_rows(csv_filename: str) -> int:
+    """
+    Counts the rows of a csv file without parsing it.
+    As for ``preprocess_csv``, this is an upper bound of the number of samples given by the input pipeline.
+
+    :param csv_filename: path to csv file
+    :return: number of rows
+    """
+    with open(csv_filename, 'rb', buffering=CONST.CSV_IO_BUFFER_SIZE) as f:
+        return sum(1 for _ in f)
 
 
 def data_preprocessing(params: Params) -> (str, str, int, int):
     """
     Preporcesses the data for the experiment (training and evaluation data).
-    Exports the updated csv files into `<output_model_dir>/preprocessed/updated_{eval,train}.csv`
+    Exports the updated csv files into `<output_model_dir>/preprocessed/updated_{eval,train}.csv`.
+    An exported file is reused if it is more recent than its input csv file and the alphabet lookup file.
 
     :param params: parameters of the experiment (``Params``)
-    :return: output path files, number of samples (for train and evaluation data)
+    :return: output path files, number of rows (upper bound of the number of samples, for train and evaluation data)
     """
     output_dir = os.path.join(params.output_model_dir, CONST.PREPROCESSING_FOLDER)
     if not os.path.exists(output_dir):
@@ -140,11 +174,22 @@ def data_preprocessing(params: Params) -> (str, str, int, int):
     csv_train_output = os.path.join(output_dir, 'updated_train.csv')
     csv_eval_output = os.path.join(output_dir, 'updated_eval.csv')
 
-    # Preprocess train csv
-    n_samples_train = preprocess_csv(params.csv_files_train, params, csv_train_output)
-
-    # Preprocess train csv
-    n_samples_eval = preprocess_csv(params.csv_files_eval, params, csv_eval_output)
-
-    return csv_train_output, csv_eval_output, n_samples_train, n_samples_eval
-
+    # Skip the files which are more recent than their inputs and preprocess the others in parallel
+    n_samples = dict()
+    csv_to_process = list()
+    for csv_input, csv_output in [(params.csv_files_train, csv_train_output),
+                                  (params.csv_files_eval, csv_eval_output)]:
+        if _is_up_to_date(csv_output, [csv_input, params.lookup_alphabet_file]):
+            print('-- {} is up to date, skipping preprocessing'.format(csv_output))
+            n_samples[csv_output] = _count_rows(csv_output)
+        else:
+            csv_to_process.append((csv_input, csv_output))
+
+    if csv_to_process:
+        with ProcessPoolExecutor(max_workers=len(csv_to_process)) as executor:
+            futures = {csv_output: executor.submit(preprocess_csv, csv_input, params, csv_output)
+                       for csv_input, csv_output in csv_to_process}
+
+            n_samples.update({csv_output: future.result() for csv_output, future in futures.items()})
+
+    return csv_train_output, csv_eval_output, n_samples[csv_train_output], n_samples[csv_eval_output]
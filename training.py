@@ -92,17 +92,19 @@ def training(_config: dict):
     model = get_model_train(parameters)
 
     # Get datasets
+    # The datasets are repeated indefinitely and epochs are bounded by the number of steps only, since some samples
+    # are filtered out by the input pipeline and the number of samples is an upper bound
     dataset_train = dataset_generator([csv_train_file],
                                       parameters,
                                       batch_size=parameters.train_batch_size,
                                       data_augmentation=parameters.data_augmentation,
-                                      num_epochs=parameters.n_epochs)
+                                      num_epochs=-1)
 
     dataset_eval = dataset_generator([csv_eval_file],
                                      parameters,
                                      batch_size=parameters.eval_batch_size,
                                      data_augmentation=False,
-                                     num_epochs=parameters.n_epochs)
+                                     num_epochs=-1)
 
     # Train model
     model.fit(dataset_train,